@@ -5,34 +5,63 @@ aircast-server.py — AirCast: Stream PC system audio to browsers over LAN.
 Author: Utkarsh (https://github.com/utkarsh-deployes)
 Purpose:
     Capture Windows system audio (via WASAPI loopback or Stereo Mix fallback)
-    and broadcast PCM frames to connected browser clients over WebSocket,
+    and broadcast PCM (or Opus) frames to connected browser clients over WebSocket,
     while serving a minimal HTML5 player UI via Flask.
 
 Usage:
     python aircast-server.py
-    python aircast-server.py --http 8080 --ws 9000 --device 2 --rate 48000 --block 2048
+    python aircast-server.py --http 8080 --ws 9000 --device 2 --rate 48000 --block 2048 --batch 4
+    python aircast-server.py --codec opus
+    python aircast-server.py --gain 0.5
 """
 
 from __future__ import annotations
 import argparse
 import asyncio
+import ctypes
+import json
+import math
 import socket
 import sys
 import signal
 from threading import Thread
-from typing import Optional, Set
+from typing import Optional, Tuple
 
 from flask import Flask, send_from_directory
+from waitress import serve
 import sounddevice as sd
 import numpy as np
 import websockets
 
+try:
+    import opuslib
+except ImportError:  # Opus streaming is optional
+    opuslib = None
+
+try:
+    import uvloop
+except ImportError:  # uvloop is optional and unavailable on Windows
+    uvloop = None
+
 # ------------------ Defaults ------------------
 DEFAULT_SAMPLE_RATE = 44100
 DEFAULT_CHANNELS = 2
 DEFAULT_BLOCK = 1024
+DEFAULT_BATCH = 4
 DEFAULT_HTTP_PORT = 5000
 DEFAULT_WS_PORT = 8765
+OPUS_SAMPLE_RATE = 48000
+OPUS_BLOCK = 960  # 20 ms at 48 kHz
+OPUS_BITRATE = 64000
+OPUS_SAMPLE_RATES = (8000, 12000, 16000, 24000, 48000)
+OPUS_FRAME_MS = (2.5, 5, 10, 20, 40, 60)
+AUDIO_QUEUE_SIZE = 8  # captured blocks buffered ahead of the broadcaster
+CLIENT_BACKLOG_SECONDS = 1.0  # audio queued in user space before a client skips audio (the only audio backpressure)
+CLIENT_SNDBUF_SECONDS = 0.5  # audio the kernel send buffer may hold per client
+# Worst case a stalled client can fall behind: CLIENT_BACKLOG_SECONDS plus one
+# batch in user space, plus CLIENT_SNDBUF_SECONDS in the kernel (Linux doubles
+# SO_SNDBUF, so up to 2x there) — about 1.6 s on Windows, 2.1 s on Linux.
+HIGH_PRIORITY_CLASS = 0x80  # Windows process priority class
 
 # ------------------ Flask UI ------------------
 app = Flask(__name__)
@@ -43,9 +72,9 @@ def index():
     return send_from_directory(".", "aircast-client.html")
 
 def start_http_server(host: str, port: int = DEFAULT_HTTP_PORT):
-    """Run Flask UI server in a separate thread."""
+    """Run Flask UI under waitress in a separate thread."""
     print(f"[HTTP] Web UI available at: http://{host}:{port}")
-    app.run(host="0.0.0.0", port=port, threaded=True)
+    serve(app, host="0.0.0.0", port=port, threads=2)
 
 # ------------------ Utilities ------------------
 def get_local_ip() -> str:
@@ -73,18 +102,103 @@ def list_devices() -> list:
         print(f"[AUDIO] Failed to query devices: {e}")
         return []
 
+def stream_byte_rate(info: dict) -> float:
+    """Bytes per second the broadcast stream puts on each client's socket."""
+    if info["codec"] == "opus":
+        # Opus bitrate plus the 2-byte length prefix on every packet
+        return OPUS_BITRATE / 8 + 2 * info["sampleRate"] / info["frameSize"]
+    return info["sampleRate"] * info["channels"] * 2
+
+def tune_socket(websocket) -> None:
+    """Set TCP_NODELAY and size the send buffer to the stream on a client's socket."""
+    sock = websocket.transport.get_extra_info("socket")
+    if sock is None:
+        return
+    # Data in the kernel buffer is invisible to the backlog check in
+    # broadcast_audio, so cap it at a fixed duration of audio. This also
+    # turns off send-buffer auto-tuning on Windows, which is intended.
+    sndbuf = int(stream_byte_rate(stream_info) * CLIENT_SNDBUF_SECONDS)
+    try:
+        # asyncio and uvloop already set TCP_NODELAY; restated explicitly
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
+    except OSError as e:
+        print(f"[WS] Socket tuning failed: {e}")
+
+def raise_process_priority() -> None:
+    """Move the process to HIGH_PRIORITY_CLASS on Windows to cut scheduling jitter."""
+    if sys.platform != "win32":
+        return
+    from ctypes import wintypes
+    # Private handle: use_last_error makes the error code reliable, and
+    # prototypes set here don't leak into the shared ctypes.windll.kernel32
+    kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+    kernel32.GetCurrentProcess.restype = wintypes.HANDLE
+    kernel32.SetPriorityClass.argtypes = (wintypes.HANDLE, wintypes.DWORD)
+    kernel32.SetPriorityClass.restype = wintypes.BOOL
+    if kernel32.SetPriorityClass(kernel32.GetCurrentProcess(), HIGH_PRIORITY_CLASS):
+        print("[MAIN] Process priority raised to HIGH.")
+    else:
+        print(f"[MAIN] Could not raise process priority (error {ctypes.get_last_error()}).")
+
+def register_pro_audio_thread() -> bool:
+    """Register the calling thread with MMCSS as a "Pro Audio" task (Windows only).
+
+    On failure the reason is available from ctypes.get_last_error() on the same thread.
+    """
+    try:
+        from ctypes import wintypes
+        avrt = ctypes.WinDLL("avrt", use_last_error=True)
+        avrt.AvSetMmThreadCharacteristicsW.argtypes = (wintypes.LPCWSTR, ctypes.POINTER(wintypes.DWORD))
+        avrt.AvSetMmThreadCharacteristicsW.restype = wintypes.HANDLE
+        task_index = wintypes.DWORD(0)
+        return bool(avrt.AvSetMmThreadCharacteristicsW("Pro Audio", ctypes.byref(task_index)))
+    except (AttributeError, OSError):
+        return False
+
+def put_latest(queue: asyncio.Queue, item) -> None:
+    """Put item on a bounded queue, dropping the oldest entry when full."""
+    if queue.full():
+        queue.get_nowait()
+    queue.put_nowait(item)
+
 # ------------------ Audio Capture ------------------
-def open_wasapi_loopback(device_idx: int, samplerate: int, channels: int, blocksize: int):
+try:
+    WASAPI_SETTINGS = sd.WasapiSettings(loopback=True)
+except Exception:  # sounddevice build without WASAPI loopback support
+    WASAPI_SETTINGS = None
+
+def make_audio_callback(loop: asyncio.AbstractEventLoop, queue: asyncio.Queue):
+    """Build a PortAudio callback that hands captured blocks to the event loop."""
+    mmcss_pending = sys.platform == "win32"
+
+    def audio_callback(indata, frames, time, status):
+        nonlocal mmcss_pending
+        if mmcss_pending:
+            # Runs on PortAudio's capture thread, so register it on first entry
+            mmcss_pending = False
+            if not register_pro_audio_thread():
+                loop.call_soon_threadsafe(
+                    print, f"[AUDIO] Could not register capture thread with MMCSS (error {ctypes.get_last_error()})"
+                )
+        if status.input_overflow:
+            loop.call_soon_threadsafe(print, "[AUDIO] Buffer overflow — some frames dropped")
+        loop.call_soon_threadsafe(put_latest, queue, bytes(indata))
+    return audio_callback
+
+def open_wasapi_loopback(devices: list, device_idx: int, samplerate: int, channels: int, blocksize: int, callback):
     """Attempt to open WASAPI loopback stream."""
+    if WASAPI_SETTINGS is None or devices[device_idx]["max_output_channels"] < 1:
+        return None  # loopback captures an output device
     try:
-        settings = sd.WasapiSettings(loopback=True)
-        stream = sd.InputStream(
+        stream = sd.RawInputStream(
             device=device_idx,
             samplerate=samplerate,
             channels=channels,
             blocksize=blocksize,
             dtype="int16",
-            extra_settings=settings,
+            extra_settings=WASAPI_SETTINGS,
+            callback=callback,
         )
         stream.start()
         print(f"[AUDIO] WASAPI loopback started (device={device_idx})")
@@ -93,15 +207,18 @@ def open_wasapi_loopback(device_idx: int, samplerate: int, channels: int, blocks
         print(f"[AUDIO] WASAPI loopback failed: {e}")
         return None
 
-def open_standard_input(device_idx: int, samplerate: int, channels: int, blocksize: int):
+def open_standard_input(devices: list, device_idx: int, samplerate: int, channels: int, blocksize: int, callback):
     """Fallback: Open normal input stream (Stereo Mix / Microphone)."""
+    if devices[device_idx]["max_input_channels"] < 1:
+        return None
     try:
-        stream = sd.InputStream(
+        stream = sd.RawInputStream(
             device=device_idx,
             samplerate=samplerate,
             channels=channels,
             blocksize=blocksize,
             dtype="int16",
+            callback=callback,
         )
         stream.start()
         print(f"[AUDIO] Standard input stream started (device={device_idx})")
@@ -110,41 +227,110 @@ def open_standard_input(device_idx: int, samplerate: int, channels: int, blocksi
         print(f"[AUDIO] Input stream failed: {e}")
         return None
 
-# ------------------ WebSocket Handling ------------------
-clients: Set[websockets.WebSocketServerProtocol] = set()
-audio_stream: Optional[sd.InputStream] = None
+def apply_gain(samples, out, gain):
+    """Scale int16 samples by gain into out, clipping to the int16 range.
+
+    main() replaces this with a numba-compiled version when --gain is used,
+    so a block is processed in one pass with no temporary arrays.
+    """
+    for i in range(samples.shape[0]):
+        v = samples[i] * gain
+        if v > 32767.0:
+            v = 32767.0
+        elif v < -32768.0:
+            v = -32768.0
+        out[i] = np.int16(v)
+
+
+def create_opus_encoder(samplerate: int, channels: int, blocksize: int):
+    """Create an Opus encoder for the capture format, or None if unsupported."""
+    if opuslib is None:
+        print("[AUDIO] Opus codec requires opuslib (pip install opuslib) and libopus.")
+        return None
+    if samplerate not in OPUS_SAMPLE_RATES:
+        print(f"[AUDIO] Opus does not support rate {samplerate}; use one of {OPUS_SAMPLE_RATES}.")
+        return None
+    if blocksize * 1000 / samplerate not in OPUS_FRAME_MS:
+        print(f"[AUDIO] Opus needs a block of {OPUS_FRAME_MS} ms; got {blocksize} frames at {samplerate} Hz.")
+        return None
+    try:
+        encoder = opuslib.Encoder(samplerate, channels, "audio")
+        encoder.bitrate = OPUS_BITRATE
+        return encoder
+    except Exception as e:
+        print(f"[AUDIO] Opus encoder failed: {e}")
+        return None
 
-async def broadcast_audio(blocksize: int, samplerate: int, channels: int):
-    """Continuously capture PCM audio and send to connected clients."""
-    global audio_stream, clients
-    if audio_stream is None:
+# ------------------ WebSocket Handling ------------------
+# Immutable snapshot, rebuilt only when a client connects or disconnects
+clients: Tuple[websockets.WebSocketServerProtocol, ...] = ()
+audio_stream: Optional[sd.RawInputStream] = None
+audio_queue: Optional[asyncio.Queue] = None
+stream_info: dict = {}
+
+async def broadcast_audio(blocksize: int, samplerate: int, channels: int, batch: int, encoder=None, gain: float = 1.0):
+    """Continuously capture audio and send to connected clients in batches of blocks.
+
+    Blocks go out as raw int16 PCM, or as Opus packets each prefixed with a
+    2-byte little-endian length when an encoder is given. A gain other than
+    1.0 is applied to the PCM before encoding.
+    """
+    global audio_stream, audio_queue, clients
+    if audio_stream is None or audio_queue is None:
         print("[WS] No audio stream — cannot broadcast.")
         return
 
-    print(f"[WS] Broadcasting audio (rate={samplerate}, channels={channels}, block={blocksize})")
+    # Size the slow-client cutoff in time, not bytes, so it means the same for
+    # PCM and Opus. A batch is only written while a client's backlog is under
+    # the limit, so at most CLIENT_BACKLOG_SECONDS plus one batch of audio
+    # (about 1.1 s at the defaults) waits in user space for any client.
+    backlog_limit = int(stream_byte_rate(stream_info) * CLIENT_BACKLOG_SECONDS)
+
+    # Several blocks go out as one WebSocket message to amortize framing overhead
+    batch_buf = bytearray()
+    pending = 0
+    # Gain output lives in a ctypes buffer: opuslib's encode() needs an object
+    # ctypes.cast() accepts, and bytearray/memoryview are not, so this lets
+    # both the Opus and PCM paths use it without a per-block bytes copy
+    gain_pcm = (ctypes.c_char * (blocksize * channels * 2))()
+    gain_out = np.frombuffer(gain_pcm, dtype=np.int16)
+
+    print(f"[WS] Broadcasting audio (rate={samplerate}, channels={channels}, block={blocksize}, batch={batch})")
     try:
         while True:
-            data, overflow = audio_stream.read(blocksize)
-            if overflow:
-                print("[AUDIO] Buffer overflow — some frames dropped")
-
-            try:
-                raw = data.tobytes()
-            except Exception as e:
-                print(f"[AUDIO] Conversion error: {e}")
-                continue
-
-            # Send to all clients
-            disconnected = []
-            for ws in clients.copy():
+            # Blocks arrive from the PortAudio callback thread, so waiting
+            # here never stalls the event loop.
+            block = await audio_queue.get()
+            if gain != 1.0:
+                apply_gain(np.frombuffer(block, dtype=np.int16), gain_out, gain)
+                block = gain_pcm
+            if encoder is not None:
+                # opuslib calls into libopus via ctypes, which releases the GIL,
+                # so encoding on a worker thread keeps the event loop free
                 try:
-                    await ws.send(raw)
-                except Exception:
-                    disconnected.append(ws)
-            for ws in disconnected:
-                clients.discard(ws)
+                    block = await asyncio.to_thread(encoder.encode, block, blocksize)
+                except Exception as e:
+                    print(f"[AUDIO] Opus encode error: {e}")
+                    continue
+                batch_buf += len(block).to_bytes(2, "little")
+            batch_buf += block
+            pending += 1
+            if pending < batch:
+                continue
 
-            await asyncio.sleep(0)
+            # Write the batch to every client in one synchronous pass; clients
+            # that can't keep up skip audio until their socket drains. This
+            # filter is the only backpressure: broadcast() never awaits drain(),
+            # so serve()'s write_limit does not apply here. broadcast() still
+            # serializes (copies) the payload once per connection; passing the
+            # bytearray only avoids an extra bytes(batch_buf) copy. Reusing it
+            # is safe because those copies are made before broadcast() returns.
+            websockets.broadcast(
+                (ws for ws in clients if ws.transport.get_write_buffer_size() < backlog_limit),
+                batch_buf,
+            )
+            batch_buf.clear()
+            pending = 0
     except asyncio.CancelledError:
         print("[WS] Broadcast stopped.")
     except Exception as e:
@@ -153,21 +339,40 @@ async def broadcast_audio(blocksize: int, samplerate: int, channels: int):
 async def ws_handler(websocket):
     """Manage a single websocket client connection."""
     global clients
-    clients.add(websocket)
+    tune_socket(websocket)
+    # Tell the client how to decode the stream before any audio arrives
+    try:
+        await websocket.send(json.dumps(stream_info))
+    except websockets.ConnectionClosed:
+        return
+    clients += (websocket,)
     addr = websocket.remote_address
     print(f"[WS] Client connected: {addr} (total={len(clients)})")
 
     try:
         await websocket.wait_closed()
     finally:
-        clients.discard(websocket)
+        clients = tuple(ws for ws in clients if ws is not websocket)
         print(f"[WS] Client disconnected: {addr} (total={len(clients)})")
 
-async def start_ws_server(host: str, ws_port: int, blocksize: int, samplerate: int, channels: int):
+async def start_ws_server(host: str, ws_port: int, blocksize: int, samplerate: int, channels: int, batch: int, encoder=None, gain: float = 1.0):
     """Start the WebSocket server and audio broadcast task."""
     print(f"[WS] Listening on ws://{host}:{ws_port}")
-    async with websockets.serve(ws_handler, "0.0.0.0", ws_port, max_size=None):
-        task = asyncio.create_task(broadcast_audio(blocksize, samplerate, channels))
+    # Audio is already dense, so permessage-deflate would only burn CPU;
+    # no extensions or subprotocols are ever negotiated on this stream
+    async with websockets.serve(
+        ws_handler,
+        "0.0.0.0",
+        ws_port,
+        max_size=None,
+        compression=None,
+        extensions=[],
+        subprotocols=None,
+        write_limit=2**20,  # only bounds awaited send(); broadcast() bypasses it
+        ping_interval=20,
+        ping_timeout=20,
+    ):
+        task = asyncio.create_task(broadcast_audio(blocksize, samplerate, channels, batch, encoder, gain))
         try:
             await asyncio.Future()  # run indefinitely
         except asyncio.CancelledError:
@@ -177,19 +382,49 @@ async def start_ws_server(host: str, ws_port: int, blocksize: int, samplerate: i
 
 # ------------------ Main Entry ------------------
 def main():
-    global audio_stream
+    global audio_stream, audio_queue, stream_info, apply_gain
 
     parser = argparse.ArgumentParser(description="AirCast — Stream PC audio to browsers over LAN")
     parser.add_argument("--http", type=int, default=DEFAULT_HTTP_PORT, help="HTTP UI port (default 5000)")
     parser.add_argument("--ws", type=int, default=DEFAULT_WS_PORT, help="WebSocket port (default 8765)")
     parser.add_argument("--device", type=int, default=None, help="Audio device index to use")
-    parser.add_argument("--rate", type=int, default=DEFAULT_SAMPLE_RATE, help="Sample rate (default 44100)")
-    parser.add_argument("--block", type=int, default=DEFAULT_BLOCK, help="Audio block size (default 1024)")
+    parser.add_argument("--rate", type=int, default=None, help="Sample rate (default 44100, or 48000 with --codec opus)")
+    parser.add_argument("--block", type=int, default=None, help="Audio block size (default 1024, or 960 with --codec opus)")
     parser.add_argument("--channels", type=int, default=DEFAULT_CHANNELS, help="Channels (default 2)")
+    parser.add_argument("--batch", type=int, default=DEFAULT_BATCH, help="Audio blocks per WebSocket message (default 4)")
+    parser.add_argument("--codec", choices=("pcm", "opus"), default="pcm", help="Stream codec (default pcm)")
+    parser.add_argument("--gain", type=float, default=1.0, help="Finite volume multiplier, needs numba (default 1.0)")
     args = parser.parse_args()
+    if args.rate is None:
+        args.rate = OPUS_SAMPLE_RATE if args.codec == "opus" else DEFAULT_SAMPLE_RATE
+    if args.block is None:
+        args.block = OPUS_BLOCK if args.codec == "opus" else DEFAULT_BLOCK
 
     print("=== AirCast Server — by Utkarsh ===")
-    print(f"[CONFIG] HTTP={args.http}, WS={args.ws}, Rate={args.rate}, Block={args.block}, Channels={args.channels}")
+    print(f"[CONFIG] HTTP={args.http}, WS={args.ws}, Rate={args.rate}, Block={args.block}, Channels={args.channels}, Batch={args.batch}, Codec={args.codec}, Gain={args.gain}")
+
+    encoder = None
+    if args.codec == "opus":
+        encoder = create_opus_encoder(args.rate, args.channels, args.block)
+        if encoder is None:
+            sys.exit(1)
+    if not math.isfinite(args.gain):
+        print(f"[AUDIO] --gain must be a finite number, got {args.gain} — exiting.")
+        sys.exit(1)
+    if args.gain != 1.0:
+        # Imported here so the default --gain 1.0 never pays numba's import cost
+        try:
+            from numba import njit
+        except ImportError:
+            print("[AUDIO] --gain requires numba (pip install numba) — exiting.")
+            sys.exit(1)
+        apply_gain = njit(cache=True)(apply_gain)
+        # Compile the kernel now rather than on the first audio block; the
+        # input must be read-only like the np.frombuffer(bytes) view in the
+        # broadcast loop, since numba specializes on array writability
+        apply_gain(np.frombuffer(bytes(2), dtype=np.int16), np.frombuffer((ctypes.c_char * 2)(), dtype=np.int16), args.gain)
+    raise_process_priority()
+    stream_info = {"codec": args.codec, "sampleRate": args.rate, "channels": args.channels, "frameSize": args.block}
 
     devices = list_devices()
     if not devices:
@@ -197,21 +432,35 @@ def main():
         sys.exit(1)
 
     # Pick device(s)
+    if args.device is not None and not 0 <= args.device < len(devices):
+        print(f"[AUDIO] Device index {args.device} is out of range (0-{len(devices) - 1}) — exiting.")
+        sys.exit(1)
     if args.device is not None:
         candidates = [args.device]
     else:
         candidates = [i for i, d in enumerate(devices) if d["max_output_channels"] > 0]
         candidates += [i for i, d in enumerate(devices) if "stereo" in d["name"].lower()]
 
+    # libuv-based loop is much cheaper on socket I/O where available
+    if uvloop is not None and sys.platform != "win32":
+        loop = uvloop.new_event_loop()
+    else:
+        loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    audio_queue = asyncio.Queue(maxsize=AUDIO_QUEUE_SIZE)
+    callback = make_audio_callback(loop, audio_queue)
+
     # Try WASAPI or fallback
+    if WASAPI_SETTINGS is None:
+        print("[AUDIO] WASAPI loopback not supported — trying standard input devices only.")
     for idx in candidates:
-        stream = open_wasapi_loopback(idx, args.rate, args.channels, args.block)
+        stream = open_wasapi_loopback(devices, idx, args.rate, args.channels, args.block, callback)
         if stream:
             audio_stream = stream
             mode = "WASAPI Loopback"
             chosen = idx
             break
-        stream = open_standard_input(idx, args.rate, args.channels, args.block)
+        stream = open_standard_input(devices, idx, args.rate, args.channels, args.block, callback)
         if stream:
             audio_stream = stream
             mode = "Input Stream"
@@ -227,19 +476,25 @@ def main():
     http_thread = Thread(target=start_http_server, args=(host_ip, args.http), daemon=True)
     http_thread.start()
 
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-
-    def shutdown_handler(sig, frame):
+    def cancel_all_tasks():
         print("\n[MAIN] Shutting down...")
         for task in asyncio.all_tasks(loop):
             task.cancel()
-        loop.stop()
 
-    signal.signal(signal.SIGINT, shutdown_handler)
+    if sys.platform == "win32":
+        # Windows event loops don't support add_signal_handler
+        def shutdown_handler(sig, frame):
+            cancel_all_tasks()
+            loop.stop()
+
+        signal.signal(signal.SIGINT, shutdown_handler)
+    else:
+        # Cancel from inside the loop so the server and broadcaster unwind normally
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, cancel_all_tasks)
 
     try:
-        loop.run_until_complete(start_ws_server(host_ip, args.ws, args.block, args.rate, args.channels))
+        loop.run_until_complete(start_ws_server(host_ip, args.ws, args.block, args.rate, args.channels, args.batch, encoder, args.gain))
     except KeyboardInterrupt:
         pass
     finally: